@@ -3,5 +3,7 @@ CREATE TABLE migrations_applied (
     id int NOT NULL AUTO_INCREMENT,
     name varchar(256) not null,
     date datetime not null,
+    schema_hash char(32) null,
+    schema_tables longtext null,
     PRIMARY KEY (id)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
@@ -2,5 +2,7 @@
 CREATE TABLE migrations_applied (
     id serial primary key,
     name text not null,
-    date TIMESTAMP WITH TIME ZONE not null
+    date TIMESTAMP WITH TIME ZONE not null,
+    schema_hash char(32) null,
+    schema_tables text null
 );
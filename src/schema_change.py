@@ -1,17 +1,199 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import json
+import time
 import codecs
+import uuid
+import hashlib
+import zipfile
+import functools
+import threading
 from glob import glob
+from contextlib import contextmanager
 
 import yaml
 import argparse
 import pymysql.cursors
 import pymysql.constants.CLIENT
 import psycopg2.extras
+import psycopg2.errors
 import psycopg2
 
+# Spans recorded while profiling is enabled (see `start_profiling()`)
+trace_events = None
+trace_start = 0
+trace_context = threading.local()
+
+# Open migration archives (see `pack_migrations()`)
+archives = {}
+
+# Maximum number of partitions a migration is loaded in (see `get_partitions()`)
+max_partitions = 32
+
+# Statements allowed in partitioned migrations
+partition_statement_re = re.compile(
+    r'^\s*(?:/\*.*?\*/\s*)*(INSERT|COPY)\b', re.IGNORECASE | re.DOTALL)
+
+# Pre and post-migration hooks execution modes
+hooks_modes = ['always', 'on_change', 'once_per_server']
+
+# Hash of the definition (columns, indexes and constraints) of each table, computed server side
+schema_tables_sql = {
+    'postgresql': """
+        SELECT name, md5(string_agg(definition, ',' ORDER BY definition COLLATE "C")) AS hash
+        FROM (
+            SELECT n.nspname || '.' || r.relname AS name,
+                   concat_ws(' ', 'column', a.attnum, a.attname, format_type(a.atttypid, a.atttypmod),
+                             CASE WHEN a.attnotnull THEN 'not null' END, pg_get_expr(d.adbin, d.adrelid)) AS definition
+            FROM pg_attribute a
+            JOIN pg_class r ON r.oid = a.attrelid
+            JOIN pg_namespace n ON n.oid = r.relnamespace
+            LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+            WHERE a.attnum > 0 AND NOT a.attisdropped AND r.relkind IN ('r', 'p', 'v', 'm', 'f')
+              AND n.nspname <> 'information_schema' AND left(n.nspname, 3) <> 'pg_' AND r.relname <> 'migrations_applied'
+            UNION ALL
+            SELECT schemaname || '.' || tablename, concat_ws(' ', 'index', indexdef)
+            FROM pg_indexes
+            WHERE schemaname NOT IN ('pg_catalog', 'information_schema') AND tablename <> 'migrations_applied'
+            UNION ALL
+            SELECT n.nspname || '.' || r.relname, concat_ws(' ', 'constraint', c.conname, pg_get_constraintdef(c.oid))
+            FROM pg_constraint c
+            JOIN pg_class r ON r.oid = c.conrelid
+            JOIN pg_namespace n ON n.oid = r.relnamespace
+            WHERE c.contype IN ('c', 'f', 'p', 'u', 'x')
+              AND n.nspname NOT IN ('pg_catalog', 'information_schema') AND r.relname <> 'migrations_applied'
+        ) AS definitions
+        GROUP BY name""",
+    'mysql': """
+        SELECT name, MD5(GROUP_CONCAT(definition ORDER BY CAST(definition AS BINARY) SEPARATOR ',')) AS hash
+        FROM (
+            SELECT table_name AS name,
+                   CONCAT_WS(' ', 'column', ordinal_position, column_name, column_type, is_nullable, column_default, extra) AS definition
+            FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name <> 'migrations_applied'
+            UNION ALL
+            SELECT table_name, CONCAT_WS(' ', 'index', index_name, non_unique, seq_in_index, column_name, index_type)
+            FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name <> 'migrations_applied'
+            UNION ALL
+            SELECT table_name, CONCAT_WS(' ', 'foreign key', constraint_name, column_name, referenced_table_name, referenced_column_name)
+            FROM information_schema.key_column_usage
+            WHERE table_schema = DATABASE() AND referenced_table_name IS NOT NULL AND table_name <> 'migrations_applied'
+        ) AS definitions
+        GROUP BY name""",
+}
+
+# Hash of the whole schema, computed from the hash of each table
+schema_hash_sql = {
+    'postgresql': """
+        SELECT md5(coalesce(string_agg(name || ':' || hash, ',' ORDER BY name COLLATE "C"), '')) AS schema_hash
+        FROM (%s) AS tables""" % schema_tables_sql['postgresql'],
+    'mysql': """
+        SELECT MD5(IFNULL(GROUP_CONCAT(CONCAT(name, ':', hash) ORDER BY CAST(name AS BINARY) SEPARATOR ','), '')) AS schema_hash
+        FROM (%s) AS tables""" % schema_tables_sql['mysql'],
+}
+
+
+@contextmanager
+def trace(name, **args):
+    """ Record a span around a phase when profiling is enabled """
+
+    if trace_events is None:
+        yield
+        return
+
+    # Inherit arguments (tag, migration) from enclosing spans
+    parent = getattr(trace_context, 'args', {})
+    trace_context.args = dict(parent, **args)
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        trace_events.append({
+            'name': name,
+            'ph': 'X',
+            'ts': (start - trace_start) * 1000000,
+            'dur': (end - start) * 1000000,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': trace_context.args,
+        })
+        trace_context.args = parent
+
+
+def traced(function):
+    """ Decorator recording a span named after the function """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with trace(function.__name__):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def start_profiling():
+    """ Start recording spans """
+
+    global trace_events, trace_start
+
+    trace_events = []
+    trace_start = time.perf_counter()
+
+    return True
+
+
+def stop_profiling():
+    """ Stop recording spans and return the recorded events """
+
+    global trace_events
+
+    events, trace_events = trace_events, None
+
+    return events or []
+
+
+def write_trace(events, path):
+    """ Write events to a Chrome trace file (chrome://tracing, Perfetto) """
+
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
 
+    return True
+
+
+def get_profile_summary(events):
+    """ Aggregate events per phase, slowest phases first """
+
+    phases = {}
+    for event in events:
+        phase = phases.setdefault(
+            event['name'], {'name': event['name'], 'count': 0, 'total': 0, 'max': 0})
+        phase['count'] += 1
+        phase['total'] += event['dur'] / 1000
+        phase['max'] = max(phase['max'], event['dur'] / 1000)
+
+    return sorted(phases.values(), key=lambda phase: phase['total'], reverse=True)
+
+
+def print_profile_summary(events):
+    """ Print a summary table of the time spent per phase """
+
+    print(' * Profile summary')
+    print('   %-24s %8s %12s %12s %12s' %
+          ('Phase', 'Count', 'Total (ms)', 'Avg (ms)', 'Max (ms)'))
+    for phase in get_profile_summary(events):
+        print('   %-24s %8d %12.2f %12.2f %12.2f' % (phase['name'], phase['count'], phase['total'],
+                                                     phase['total'] / phase['count'], phase['max']))
+
+    return True
+
+
+@traced
 def get_config(override=None):
     """ Get config file """
 
@@ -35,19 +217,110 @@ def check_exists(path, type='file'):
     """ Check if a file or a folder exists """
 
     if type == 'file':
-        if not os.path.isfile(path):
+        archive_path = split_archive_path(path)
+        if archive_path:
+            archive, member = archive_path
+            if member not in get_archive(archive).namelist():
+                raise RuntimeError('The file `%s` does not exist.' % path)
+        elif not os.path.isfile(path):
             raise RuntimeError('The file `%s` does not exist.' % path)
     else:
-        if not os.path.isdir(path):
+        if is_archive(path):
+            if not zipfile.is_zipfile(path.rstrip('/')):
+                raise RuntimeError(
+                    'The file `%s` is not a valid archive.' % path.rstrip('/'))
+        elif not os.path.isdir(path):
             raise RuntimeError('The folder `%s` does not exist.' % path)
 
     return True
 
 
+def is_archive(path):
+    """ Check if a migration path points to a packed archive (a file rather than a folder) """
+
+    return os.path.isfile(path.rstrip('/'))
+
+
+def split_archive_path(file):
+    """
+        Returns the archive and the member name of a file within a packed archive, for example:
+        `/path/to/migrations.zip/migration1/up.sql` -> (`/path/to/migrations.zip`, `migration1/up.sql`)
+        The archive is the first parent that is a file (see `is_archive()`)
+        Returns `None` for regular files
+    """
+
+    # Regular files are found with a single lookup
+    if os.path.isfile(file):
+        return None
+
+    archive = os.path.dirname(file)
+    while archive and archive != os.path.dirname(archive):
+        if is_archive(archive):
+            return archive, file[len(archive) + 1:]
+        archive = os.path.dirname(archive)
+
+    return None
+
+
+def get_archive(archive):
+    """ Returns an open archive, opening it only once """
+
+    if archive not in archives:
+        try:
+            archives[archive] = zipfile.ZipFile(archive)
+        except zipfile.BadZipFile:
+            raise RuntimeError(
+                'The file `%s` is not a valid archive.' % archive)
+
+    return archives[archive]
+
+
+def close_archive(archive):
+    """ Close an archive previously opened with `get_archive()` """
+
+    if archive in archives:
+        archives.pop(archive).close()
+
+    return True
+
+
+def pack_migrations(path, archive):
+    """ Pack a migrations folder into a single indexed archive """
+
+    path = add_slash(path)
+
+    # Check if the migration path exists
+    check_exists(path, 'dir')
+
+    files = glob(path + '*/*.sql')
+    files.sort()
+
+    # Members are stored uncompressed so that reading one is a single seek
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as f:
+        for file in files:
+            name = get_migration_name(file) + '/' + os.path.basename(file)
+            f.write(file, name)
+
+    # Drop a previously opened version of the archive
+    close_archive(archive)
+
+    # Log
+    print(' * %d files packed into `%s`' % (len(files), archive))
+
+    return True
+
+
+@traced
 def get_migrations_files(path):
     """ List migrations folders """
 
-    migrations = glob(path + '*/up.sql')
+    if is_archive(path):
+        # List members from the archive index
+        archive = path.rstrip('/')
+        migrations = [add_slash(archive) + name for name in get_archive(archive).namelist()
+                      if name.count('/') == 1 and name.endswith('/up.sql')]
+    else:
+        migrations = glob(path + '*/up.sql')
     migrations.sort()
 
     return migrations
@@ -74,10 +347,16 @@ def get_migration_name(file):
 def get_migration_source(file):
     """ Returns migration source code """
 
+    archive_path = split_archive_path(file)
+    if archive_path:
+        archive, member = archive_path
+        return get_archive(archive).read(member).decode('utf-8')
+
     with open(file, "r") as f:
         return f.read()
 
 
+@traced
 def get_connection(engine, host, user, port, password, database, ssl={}):
     """ Returns a PostgreSQL or MySQL connection """
 
@@ -121,6 +400,7 @@ def get_pg_connection(host, user, port, password, database, ssl={}):
                             )
 
 
+@traced
 def parse_statements(queries_input, engine):
     """ Parse input and return a list of SQL statements """
 
@@ -169,30 +449,271 @@ def parse_statements(queries_input, engine):
     return queries
 
 
-def run_migration(connection, queries, engine):
+def get_backend_id(connection, engine):
+    """ Returns the server side identifier of a connection """
+
+    if engine == 'postgresql':
+        return connection.get_backend_pid()
+
+    return connection.thread_id()
+
+
+def cancel_backend(engine, connection, backend_id):
+    """ Cancel the statement running on another connection """
+
+    with connection.cursor() as cursor:
+        if engine == 'postgresql':
+            cursor.execute('SELECT pg_cancel_backend(%s)', (backend_id,))
+        else:
+            cursor.execute('KILL QUERY %s', (backend_id,))
+        connection.commit()
+
+    return True
+
+
+def get_statement_budget(time_budget, started):
+    """ Returns the time (in seconds) the next statement of a migration may run for """
+
+    budgets = []
+    if time_budget.get('statement_timeout'):
+        budgets.append(time_budget['statement_timeout'])
+    if time_budget.get('migration_timeout'):
+        elapsed = time.monotonic() - started
+        budgets.append(time_budget['migration_timeout'] - elapsed)
+
+    return min(budgets) if budgets else None
+
+
+def execute_with_watchdog(connection, cursor, query, engine, budget, connect):
+    """ Execute a statement, cancelling it from a side connection if it exceeds its time budget """
+
+    # The migration budget is already spent, do not start the statement
+    if budget <= 0:
+        connection.rollback()
+        raise RuntimeError(
+            'The migration exceeded its time budget before running the statement:\n%s' % query)
+
+    backend_id = get_backend_id(connection, engine)
+    expired = threading.Event()
+    # Error raised by the watchdog while cancelling the statement
+    watchdog_errors = []
+
+    def watchdog():
+        expired.set()
+
+        try:
+            side_connection = connect()
+            try:
+                cancel_backend(engine, side_connection, backend_id)
+            finally:
+                side_connection.close()
+        except Exception as e:
+            # Reported by the executing thread
+            watchdog_errors.append(e)
+
+    timer = threading.Timer(budget, watchdog)
+    timer.daemon = True
+    timer.start()
+
+    try:
+        cursor.execute(query)
+    except (psycopg2.Error, pymysql.err.Error):
+        if not expired.is_set():
+            raise
+    finally:
+        # Wait for a watchdog already cancelling the statement
+        timer.cancel()
+        timer.join()
+
+    if expired.is_set():
+        connection.rollback()
+
+        if watchdog_errors:
+            raise RuntimeError(
+                'The statement exceeded its time budget of %.1fs and could not be cancelled (%s):\n%s' % (budget, watchdog_errors[0], query))
+
+        raise RuntimeError(
+            'The statement exceeded its time budget of %.1fs and was cancelled:\n%s' % (budget, query))
+
+    return True
+
+
+def run_migration(connection, queries, engine, time_budget=None, connect=None):
     """ Apply a migration to the SQL server """
 
+    # Parse statements
+    queries = parse_statements(queries, engine)
+
+    return run_statements(connection, queries, engine, time_budget, connect)
+
+
+def run_statements(connection, queries, engine, time_budget=None, connect=None, commit=True):
+    """ Run parsed statements in a single transaction, left open if `commit` is false """
+
     # Execute query
     with connection.cursor() as cursorMig:
-        # Parse statements
-        queries = parse_statements(queries, engine)
-
+        started = time.monotonic()
         for query in queries:
-            cursorMig.execute(query)
-        connection.commit()
+            budget = get_statement_budget(
+                time_budget, started) if time_budget else None
+
+            with trace('cursor.execute'):
+                if budget is None:
+                    cursorMig.execute(query)
+                else:
+                    execute_with_watchdog(
+                        connection, cursorMig, query, engine, budget, connect)
+        if commit:
+            connection.commit()
 
     return True
 
 
-def save_migration(connection, basename):
-    """ Save a migration in `migrations_applied` table """
+def get_partitions(queries):
+    """
+        Returns the number of partitions a migration is loaded in, set with a comment in the migration, for example:
+        `-- dbschema: partitions=8`
+        The number of partitions is capped at `max_partitions`
+    """
 
-    # Prepare query
-    sql = "INSERT INTO migrations_applied (name, date) VALUES (%s, NOW())"
+    match = re.search(r'^\s*--\s*dbschema:\s*partitions\s*=\s*(\d+)\s*$',
+                      queries, re.MULTILINE)
+
+    return min(max(int(match.group(1)), 1), max_partitions) if match else 1
+
+
+def split_statements(queries, partitions):
+    """ Split statements into contiguous ranges of similar sizes """
+
+    size, remainder = divmod(len(queries), partitions)
+
+    ranges = []
+    start = 0
+    for partition in range(partitions):
+        end = start + size + (1 if partition < remainder else 0)
+        if end > start:
+            ranges.append(queries[start:end])
+        start = end
+
+    return ranges
+
+
+def get_max_prepared_transactions(connection):
+    """ Returns the maximum number of prepared transactions of a PostgreSQL server """
+
+    with connection.cursor() as cursor:
+        cursor.execute('SHOW max_prepared_transactions')
+        value = int(cursor.fetchone()[0])
+    connection.commit()
+
+    return value
+
+
+def run_partitioned_migration(queries, engine, partitions, connect, time_budget=None, pre_migration=None):
+    """
+        Load a migration in partitions, in parallel, each partition on its own connection
+        Partitions are committed together once all of them are loaded, or all rolled back
+        On PostgreSQL, partitions are prepared (two-phase commit) before being committed if the server allows it
+        `pre_migration` queries run on each connection first to set up its session
+    """
+
+    # Parse statements
+    queries = parse_statements(queries, engine)
+    for query in queries:
+        if not partition_statement_re.match(query):
+            raise RuntimeError('Only INSERT and COPY statements can be loaded in partitions, found: %s' %
+                               query.split('\n')[0][:80])
+
+    ranges = split_statements(queries, partitions)
+    if not ranges:
+        return True
+
+    # Global transaction identifier of the partitions, for two-phase commit
+    gtrid = 'dbschema_%s' % uuid.uuid4().hex
+
+    # Spans of the partitions are recorded under the current migration
+    trace_args = getattr(trace_context, 'args', {})
+    # Partitions loaded and committed, and errors, by partition
+    loaded = {}
+    committed = {}
+    errors = {}
+    barrier = threading.Barrier(len(ranges))
+
+    def load(partition, queries):
+        trace_context.args = trace_args
+
+        with trace('partition', partition=partition):
+            connection = None
+            two_phase = False
+            try:
+                connection = connect()
+                if pre_migration:
+                    run_migration(connection, pre_migration, engine)
+                if engine == 'postgresql' and get_max_prepared_transactions(connection) >= len(ranges):
+                    connection.tpc_begin(connection.xid(
+                        0, '%s_%d' % (gtrid, partition), 'dbschema'))
+                    two_phase = True
+                run_statements(connection, queries, engine,
+                               time_budget, connect, commit=False)
+                if two_phase:
+                    connection.tpc_prepare()
+                loaded[partition] = True
+            except Exception as e:
+                # Reported once all partitions are done
+                errors[partition] = e
+
+            # Wait for all partitions before committing any of them
+            barrier.wait()
+
+            try:
+                if connection and len(loaded) == len(ranges):
+                    if two_phase:
+                        connection.tpc_commit()
+                    else:
+                        connection.commit()
+                    committed[partition] = True
+                elif connection and two_phase:
+                    connection.tpc_rollback()
+                elif connection:
+                    connection.rollback()
+            except Exception as e:
+                errors.setdefault(partition, e)
+            finally:
+                if connection:
+                    connection.close()
+
+    threads = [threading.Thread(target=load, args=(partition, statements))
+               for partition, statements in enumerate(ranges)]
+    for thread in threads:
+        thread.start()
+
+    # Wait for all partitions
+    for thread in threads:
+        thread.join()
+
+    if len(committed) != len(ranges):
+        failures = ['partition %d: %s' % (partition, errors[partition])
+                    for partition in sorted(errors)]
+        committed_partitions = ', '.join(
+            str(partition) for partition in sorted(committed)) or 'none'
+        raise RuntimeError('The partitioned migration failed, %d of %d partitions committed (%s):\n%s' %
+                           (len(committed), len(ranges), committed_partitions, '\n'.join(failures)))
+
+    return True
+
+
+@traced
+def save_migration(connection, basename, schema_hash=None, schema_tables=None):
+    """ Save a migration in `migrations_applied` table, optionally with the resulting schema hash """
 
     # Run
     with connection.cursor() as cursor:
-        cursor.execute(sql, (basename,))
+        if schema_hash is None:
+            sql = "INSERT INTO migrations_applied (name, date) VALUES (%s, NOW())"
+            cursor.execute(sql, (basename,))
+        else:
+            sql = "INSERT INTO migrations_applied (name, date, schema_hash, schema_tables) VALUES (%s, NOW(), %s, %s)"
+            cursor.execute(sql, (basename, schema_hash, schema_tables))
         connection.commit()
 
     return True
@@ -218,6 +739,7 @@ def is_applied(migrations_applied, migration_name):
     return [True for migration in migrations_applied if migration['name'] == migration_name]
 
 
+@traced
 def get_migrations_applied(engine, connection):
     """ Get list of migrations already applied """
 
@@ -232,6 +754,9 @@ def get_migrations_applied(engine, connection):
         sql = "SELECT id, name, date FROM migrations_applied"
         cursor.execute(sql)
         rows = cursor.fetchall()
+
+        # End the read-only transaction, not to leave the connection idle in transaction
+        connection.commit()
         # print (rows);
         return rows
     except psycopg2.ProgrammingError:
@@ -242,31 +767,189 @@ def get_migrations_applied(engine, connection):
             'The table `migrations_applied` is missing. Please refer to the project documentation at https://github.com/gabfl/dbschema.')
 
 
-def apply_migrations(engine, connection, path):
-    """ Apply all migrations in a chronological order """
+def get_dict_cursor(engine, connection):
+    """ Returns a cursor fetching rows as dictionaries """
+
+    if engine == 'postgresql':
+        return connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    return connection.cursor()
+
+
+@traced
+def get_schema_tables(engine, connection):
+    """ Returns the hash of the definition of each table """
+
+    with get_dict_cursor(engine, connection) as cursor:
+        # Avoid truncating the list of definitions of large tables
+        if engine == 'mysql':
+            cursor.execute('SET SESSION group_concat_max_len = 4294967295')
+
+        cursor.execute(schema_tables_sql[engine])
+
+        return dict((row['name'], row['hash']) for row in cursor.fetchall())
+
+
+@traced
+def get_schema_hash(engine, connection):
+    """ Returns the hash of the schema and the one expected after the most recent migration """
+
+    sql = """
+        SELECT (%s) AS schema_hash,
+               (SELECT schema_hash FROM migrations_applied WHERE schema_hash IS NOT NULL ORDER BY id DESC LIMIT 1) AS expected_hash
+    """ % schema_hash_sql[engine]
+
+    with schema_hash_columns_required(), get_dict_cursor(engine, connection) as cursor:
+        # Avoid truncating the list of definitions of large tables
+        if engine == 'mysql':
+            cursor.execute('SET SESSION group_concat_max_len = 4294967295')
+
+        cursor.execute(sql)
+
+        return cursor.fetchone()
+
+
+@contextmanager
+def schema_hash_columns_required():
+    """ Report a missing `migrations_applied.schema_hash` (or `schema_tables`) column """
+
+    try:
+        yield
+    except psycopg2.errors.UndefinedColumn:
+        raise RuntimeError(
+            'The column `migrations_applied.schema_hash` is missing. Please refer to the project documentation at https://github.com/gabfl/dbschema.')
+    except pymysql.err.OperationalError as e:
+        # Unknown column
+        if e.args[0] != 1054:
+            raise
+        raise RuntimeError(
+            'The column `migrations_applied.schema_hash` is missing. Please refer to the project documentation at https://github.com/gabfl/dbschema.')
+
+
+def check_schema_hash_columns(engine, connection):
+    """ Check that `migrations_applied` can save schema hashes, before any migration runs """
+
+    with schema_hash_columns_required(), connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT schema_hash, schema_tables FROM migrations_applied LIMIT 0')
+    connection.commit()
+
+    return True
+
+
+def hash_schema_tables(tables):
+    """
+        Returns the hash of the schema from the hash of each table,
+        the same way as `schema_hash_sql` computes it server side
+    """
+
+    schema = ','.join('%s:%s' % (name, tables[name]) for name in sorted(tables))
+
+    return hashlib.md5(schema.encode('utf-8')).hexdigest()
+
+
+def get_expected_schema_tables(engine, connection):
+    """ Returns the hash of each table expected after the most recent migration """
+
+    sql = "SELECT schema_tables FROM migrations_applied WHERE schema_hash IS NOT NULL ORDER BY id DESC LIMIT 1"
+
+    with get_dict_cursor(engine, connection) as cursor:
+        cursor.execute(sql)
+        row = cursor.fetchone()
+
+    return json.loads(row['schema_tables']) if row and row['schema_tables'] else {}
+
+
+def verify_schema(engine, connection):
+    """ Compare the schema with the one expected after the most recent migration """
+
+    # Compare hashes first, tables are only compared if they differ
+    row = get_schema_hash(engine, connection)
+    if row['expected_hash'] is None:
+        print('   -> No schema hash saved, nothing to verify')
+        return True
+
+    if row['schema_hash'] == row['expected_hash']:
+        print('   -> Schema matches the migrations')
+        return True
+
+    tables = get_schema_tables(engine, connection)
+    expected_tables = get_expected_schema_tables(engine, connection)
+
+    for name in sorted(set(tables) | set(expected_tables)):
+        if name not in tables:
+            print('   -> Table `%s` is missing' % name)
+        elif name not in expected_tables:
+            print('   -> Table `%s` is not expected' % name)
+        elif tables[name] != expected_tables[name]:
+            print('   -> Table `%s` differs' % name)
+
+    print('   -> Schema drift detected')
+
+    return False
+
+
+def get_migrations_applied_names(engine, connection, applied_cache=None):
+    """
+        Returns the names of the migrations already applied
+        They are cached in the `applied_cache` dict if provided, to be reused by later calls (see `watch()`)
+    """
+
+    if applied_cache is not None and 'names' in applied_cache:
+        return applied_cache['names']
+
+    names = set(migration['name'] for migration in get_migrations_applied(
+        engine, connection))
+
+    if applied_cache is not None:
+        applied_cache['names'] = names
+
+    return names
+
+
+def get_migrations_pending(engine, connection, path, migrations_applied=None):
+    """ List migrations files not applied yet, in a chronological order """
 
     # Get migrations applied
-    migrations_applied = get_migrations_applied(engine, connection)
-    # print(migrationsApplied)
+    if migrations_applied is None:
+        migrations_applied = get_migrations_applied_names(engine, connection)
 
-    # Get migrations folder
-    for file in get_migrations_files(path):
-        # Set vars
-        basename = os.path.basename(os.path.dirname(file))
+    return [file for file in get_migrations_files(path)
+            if get_migration_name(file) not in migrations_applied]
 
-        # Skip migrations if they are already applied
-        if is_applied(migrations_applied, basename):
-            continue
 
-        # Get migration source
-        source = get_migration_source(file)
-        # print (source);
+def apply_migrations(engine, connection, path, time_budget=None, connect=None, migrations=None, schema_hash=None, pre_migration=None):
+    """ Apply all migrations in a chronological order """
 
-        # Run migration
-        run_migration(connection, source, engine)
+    # Get pending migrations, unless already listed by the caller
+    if migrations is None:
+        migrations = get_migrations_pending(engine, connection, path)
 
-        # Save migration
-        save_migration(connection, basename)
+    for file in migrations:
+        # Set vars
+        basename = get_migration_name(file)
+
+        with trace('migration', migration=basename):
+            # Get migration source
+            source = get_migration_source(file)
+            # print (source);
+
+            # Run migration, in parallel partitions if requested
+            partitions = get_partitions(source)
+            if partitions > 1 and connect:
+                run_partitioned_migration(
+                    source, engine, partitions, connect, time_budget, pre_migration)
+            else:
+                run_migration(connection, source,
+                              engine, time_budget, connect)
+
+            # Save migration, with the resulting schema hash if enabled
+            if schema_hash:
+                tables = get_schema_tables(engine, connection)
+                save_migration(connection, basename, hash_schema_tables(tables),
+                               json.dumps(tables, sort_keys=True))
+            else:
+                save_migration(connection, basename)
 
         # Log
         print('   -> Migration `%s` applied' % (basename))
@@ -277,14 +960,15 @@ def apply_migrations(engine, connection, path):
     return True
 
 
-def rollback_migration(engine, connection, path, migration_to_rollback):
+def rollback_migration(engine, connection, path, migration_to_rollback, time_budget=None, connect=None, migrations_applied=None):
     """ Rollback a migration """
 
     # Get migrations applied
-    migrations_applied = get_migrations_applied(engine, connection)
+    if migrations_applied is None:
+        migrations_applied = get_migrations_applied_names(engine, connection)
 
     # Ensure that the migration was previously applied
-    if not is_applied(migrations_applied, migration_to_rollback):
+    if migration_to_rollback not in migrations_applied:
         raise RuntimeError(
             '`%s` is not in the list of previously applied migrations.' % (migration_to_rollback))
 
@@ -302,7 +986,7 @@ def rollback_migration(engine, connection, path, migration_to_rollback):
     # print (source);
 
     # Run migration rollback
-    run_migration(connection, source, engine)
+    run_migration(connection, source, engine, time_budget, connect)
 
     # Delete migration
     delete_migration(connection, basename)
@@ -334,64 +1018,405 @@ def get_ssl(database):
     return ssl
 
 
-def apply(config_override=None, tag_override=None, rollback=None, skip_missing=None):
+def get_time_budget(database):
+    """ Returns the time budget options (in seconds) of a database """
+
+    # Loop thru keys
+    time_budget = {}
+    for key in ['migration_timeout', 'statement_timeout']:
+        value = database.get(key)
+        if value is not None:
+            time_budget[key] = value
+
+    return time_budget
+
+
+def get_hook_key(server, queries):
+    """ Returns a key identifying hook queries ran against a server """
+
+    return server + (hashlib.sha256(queries.strip().encode('utf-8')).hexdigest(),)
+
+
+def run_hook(connection, queries, engine, hooks_mode='always', changed=True, server=(), hooks_ran=None):
+    """ Run pre or post migration queries if required by the hooks mode """
+
+    if hooks_mode not in hooks_modes:
+        raise RuntimeError('`%s` is not a valid hooks mode.' % hooks_mode)
+
+    # Skip empty hooks, and hooks of unchanged databases unless they always run
+    if not queries or (hooks_mode != 'always' and not changed):
+        return False
+
+    # Skip queries already ran against the same server during this run
+    if hooks_mode == 'once_per_server' and hooks_ran is not None:
+        key = get_hook_key(server, queries)
+        if key in hooks_ran:
+            return False
+        hooks_ran.add(key)
+
+    run_migration(connection, queries, engine)
+
+    return True
+
+
+def run_deferred_hooks(deferred_hooks):
+    """ Run post migration queries deferred by `apply_database()`, once per server """
+
+    hooks_ran = set()
+    for connection, queries, engine, server in deferred_hooks:
+        with trace('post_migration'):
+            run_hook(connection, queries, engine,
+                     'once_per_server', True, server, hooks_ran)
+
+    return True
+
+
+def get_connect(database):
+    """ Returns a function opening a new connection to a database """
+
+    return functools.partial(get_connection,
+                             database.get('engine', 'mysql'),
+                             database.get('host', 'localhost'),
+                             database['user'],
+                             database.get('port', 3306),
+                             database.get('password'),
+                             database['db'],
+                             get_ssl(database))
+
+
+def apply_database(tag, database, rollback=None, skip_missing=None, deferred_hooks=None, connection=None, applied_cache=None):
+    """
+        Apply (or rollback) migrations for a database tag
+        With the `once_per_server` hooks mode, post migration queries are appended to
+        `deferred_hooks` to run once all tags are migrated (see `run_deferred_hooks()`)
+        An already open `connection` can be provided to be reused, with an `applied_cache`
+        keeping the names of applied migrations up to date between calls
+    """
+
+    # Set vars
+    engine = database.get('engine', 'mysql')
+    host = database.get('host', 'localhost')
+    port = database.get('port', 3306)
+    db = database['db']
+    path = add_slash(database['path'])
+    pre_migration = database.get('pre_migration')
+    post_migration = database.get('post_migration')
+    hooks_mode = database.get('hooks_mode', 'always')
+    server = (engine, host, port, db)
+
+    # Check if the migration path exists
+    if skip_missing:
+        try:
+            check_exists(path, 'dir')
+        except RuntimeError:
+            return False
+    else:
+        check_exists(path, 'dir')
+
+    # Get database connection
+    connect = get_connect(database)
+    if connection is None:
+        connection = connect()
+    time_budget = get_time_budget(database)
+
+    # With the `always` hooks mode, pre migration queries run first and can
+    # prepare the session (`SET search_path`, `USE`) used to list migrations
+    if hooks_mode == 'always':
+        with trace('pre_migration'):
+            run_hook(connection, pre_migration, engine)
+
+    # List pending migrations to know if hooks need to run
+    if rollback:
+        migrations = None
+        changed = True
+    else:
+        migrations = get_migrations_pending(
+            engine, connection, path, get_migrations_applied_names(engine, connection, applied_cache))
+        changed = bool(migrations)
+
+        # Fail before running migrations that could not be saved with their schema hash
+        if database.get('schema_hash'):
+            check_schema_hash_columns(engine, connection)
+
+    # Otherwise they run after listing migrations, only if something changes.
+    # They are not deduplicated since they may set up this tag's session.
+    if hooks_mode != 'always':
+        with trace('pre_migration'):
+            run_hook(connection, pre_migration, engine, hooks_mode, changed)
+
+    if rollback:
+        print(' * Rolling back %s (`%s` on %s)' % (tag, db, engine))
+
+        migrations_applied = get_migrations_applied_names(
+            engine, connection, applied_cache)
+        rollback_migration(engine, connection, path, rollback,
+                           time_budget, connect, migrations_applied)
+
+        # Keep cached names up to date
+        migrations_applied.discard(rollback)
+    else:
+        print(' * Applying migrations for %s (`%s` on %s)' %
+              (tag, db, engine))
+
+        apply_migrations(engine, connection, path, time_budget, connect,
+                         migrations, database.get('schema_hash'), pre_migration)
+
+        # Keep cached names up to date
+        if applied_cache is not None:
+            applied_cache['names'].update(
+                get_migration_name(file) for file in migrations)
+
+    # Run post migration queries
+    if hooks_mode == 'once_per_server' and deferred_hooks is not None:
+        if post_migration and changed:
+            deferred_hooks.append(
+                (connection, post_migration, engine, server))
+    else:
+        with trace('post_migration'):
+            run_hook(connection, post_migration, engine, hooks_mode, changed)
+
+    return True
+
+
+def verify_database(tag, database, connection=None):
+    """ Check a database tag for schema drift, if it saves schema hashes """
+
+    # Set vars
+    engine = database.get('engine', 'mysql')
+    db = database['db']
+
+    if not database.get('schema_hash'):
+        print(' * Skipping %s (`%s` on %s): `schema_hash` is not enabled' %
+              (tag, db, engine))
+        return True
+
+    print(' * Verifying schema for %s (`%s` on %s)' % (tag, db, engine))
+
+    # Get database connection
+    if connection is None:
+        connection = get_connect(database)()
+
+    return verify_schema(engine, connection)
+
+
+def apply(config_override=None, tag_override=None, rollback=None, skip_missing=None, profile=None, verify=None):
     """ Look thru migrations and apply them """
 
-    # Load config
-    config = get_config(config_override)
-    databases = config['databases']
+    # Record spans if a trace file is requested
+    if profile:
+        start_profiling()
 
-    # If we are rolling back, ensure that we have a database tag
-    if rollback and not tag_override:
-        raise RuntimeError(
-            'To rollback a migration you need to specify the database tag with `--tag`')
+    try:
+        # Load config
+        config = get_config(config_override)
+        databases = config['databases']
+
+        # If we are rolling back, ensure that we have a database tag
+        if rollback and not tag_override:
+            raise RuntimeError(
+                'To rollback a migration you need to specify the database tag with `--tag`')
+
+        # Post migration queries ran once per server (see `run_deferred_hooks()`)
+        deferred_hooks = []
+
+        # Tags with a schema drift, or that could not be verified
+        drifts = []
+
+        try:
+            for tag in sorted(databases):
+                # If a tag is specified, skip other tags
+                if tag_override and tag_override != tag:
+                    continue
+
+                with trace('tag', tag=tag):
+                    if verify:
+                        # Keep verifying other tags after an error
+                        try:
+                            if not verify_database(tag, databases[tag]):
+                                drifts.append(tag)
+                        except (RuntimeError, psycopg2.Error, pymysql.err.Error) as e:
+                            print('   -> Error: %s' % e)
+                            drifts.append(tag)
+                    else:
+                        apply_database(tag, databases[tag], rollback,
+                                       skip_missing, deferred_hooks)
+        finally:
+            # Also run for tags migrated before an error in a later tag
+            run_deferred_hooks(deferred_hooks)
+
+        if drifts:
+            raise RuntimeError('Schema drift detected (or not verified) for %s.' %
+                               ', '.join('`%s`' % tag for tag in drifts))
+    finally:
+        # Write trace file and print summary
+        if profile:
+            events = stop_profiling()
+            write_trace(events, profile)
+            print_profile_summary(events)
+
+    return True
+
+
+def get_migrations_snapshot(path):
+    """ Returns the modification time and size of each migration file, to detect changes """
 
-    for tag in sorted(databases):
-        # If a tag is specified, skip other tags
-        if tag_override and tag_override != tag:
+    if is_archive(path):
+        files = [path.rstrip('/')]
+    else:
+        files = glob(path + '*/*.sql')
+
+    snapshot = {}
+    for file in files:
+        try:
+            stat = os.stat(file)
+            snapshot[file] = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            # Deleted while listing
             continue
 
-        # Set vars
-        engine = databases[tag].get('engine', 'mysql')
-        host = databases[tag].get('host', 'localhost')
-        port = databases[tag].get('port', 3306)
-        user = databases[tag]['user']
-        password = databases[tag].get('password')
-        db = databases[tag]['db']
-        path = add_slash(databases[tag]['path'])
-        pre_migration = databases[tag].get('pre_migration')
-        post_migration = databases[tag].get('post_migration')
-
-        # Check if the migration path exists
-        if skip_missing:
-            try:
-                check_exists(path, 'dir')
-            except RuntimeError:
-                continue
-        else:
-            check_exists(path, 'dir')
+    return snapshot
+
+
+def get_latest_migration(engine, connection, path, migrations_applied=None):
+    """ Returns the file of the most recent migration applied """
+
+    # Get migrations applied
+    if migrations_applied is None:
+        migrations_applied = get_migrations_applied_names(engine, connection)
 
-        # Get database connection
-        connection = get_connection(
-            engine, host, user, port, password, db, get_ssl(databases[tag]))
+    migrations = [file for file in get_migrations_files(path)
+                  if get_migration_name(file) in migrations_applied]
 
-        # Run pre migration queries
-        if pre_migration:
-            run_migration(connection, pre_migration, engine)
+    return migrations[-1] if migrations else None
 
-        if rollback:
-            print(' * Rolling back %s (`%s` on %s)' % (tag, db, engine))
 
-            rollback_migration(engine, connection, path, rollback)
+def watch_database(tag, database, connection, files_changed, redo=None, applied_cache=None):
+    """
+        Apply new migrations of a watched database, redoing the most recent one if it was modified
+        Redoing is not supported for archives, whose members are not watched individually
+    """
+
+    engine = database.get('engine', 'mysql')
+    path = add_slash(database['path'])
+
+    # Reopen a modified archive
+    if is_archive(path):
+        close_archive(path.rstrip('/'))
+
+    # Redo the most recent migration if its `up.sql` changed
+    if redo and files_changed:
+        latest = get_latest_migration(engine, connection, path,
+                                      get_migrations_applied_names(engine, connection, applied_cache))
+        if latest in files_changed:
+            apply_database(tag, database, get_migration_name(latest),
+                           connection=connection, applied_cache=applied_cache)
+
+    return apply_database(tag, database, connection=connection, applied_cache=applied_cache)
+
+
+def is_connection_error(e):
+    """ Check if an error is caused by the connection rather than by the migration """
+
+    if isinstance(e, (psycopg2.InterfaceError, pymysql.err.InterfaceError)):
+        return True
+
+    # Server gone away, lost connection, can't connect
+    if isinstance(e, pymysql.err.OperationalError):
+        return e.args[0] in (2003, 2006, 2013, 2055)
+
+    # Statements cancelled by the server are caused by the migration
+    return isinstance(e, psycopg2.OperationalError) and not isinstance(e, psycopg2.errors.QueryCanceled)
+
+
+def watch_check(tag, database, state, redo=None, retry_delay=5):
+    """
+        Check a watched database for changes and apply them
+        Changes are applied once files are unchanged between two checks, to skip files still being written
+        `state` keeps the connection, the files seen and applied and the names of applied migrations between checks
+        Returns `True` if changes were applied
+    """
+
+    # Wait for files to be unchanged since the previous check
+    snapshot = get_migrations_snapshot(add_slash(database['path']))
+    stable = snapshot == state.get('snapshot')
+    state['snapshot'] = snapshot
+    if not stable or snapshot == state.get('applied'):
+        return False
+
+    # Files that failed are retried once modified, or after a delay for connection errors
+    failure = state.get('failure')
+    if failure and failure[0] == snapshot:
+        if failure[1] is None or time.monotonic() < failure[1]:
+            return False
+
+    # Files added or modified since the previous apply
+    previous = state.get('applied')
+    files_changed = [file for file in snapshot
+                     if previous is not None and previous.get(file) != snapshot[file]]
+
+    try:
+        if 'connection' not in state:
+            state['connection'] = get_connect(database)()
+
+        with trace('tag', tag=tag):
+            watch_database(tag, database, state['connection'], files_changed,
+                           redo, state.setdefault('applied_cache', {}))
+    except (RuntimeError, psycopg2.Error, pymysql.err.Error) as e:
+        if is_connection_error(e):
+            print(' * Error: %s (retrying in %ss)' % (e, retry_delay))
+            state['failure'] = (snapshot, time.monotonic() + retry_delay)
         else:
-            print(' * Applying migrations for %s (`%s` on %s)' %
-                  (tag, db, engine))
+            print(' * Error: %s (waiting for a change)' % e)
+            state['failure'] = (snapshot, None)
+
+        # Reload applied migrations and reconnect on the next attempt
+        state.pop('applied_cache', None)
+        if 'connection' in state:
+            try:
+                state.pop('connection').close()
+            except (psycopg2.Error, pymysql.err.Error):
+                pass
+
+        return False
+
+    state['applied'] = snapshot
+    state.pop('failure', None)
+
+    return True
+
 
-            apply_migrations(engine, connection, path)
+def watch(config_override=None, tag_override=None, redo=None, interval=0.25, iterations=None, retry_delay=5):
+    """ Watch migrations folders and apply new migrations as they appear """
 
-        # Run post migration queries
-        if post_migration:
-            run_migration(connection, post_migration, engine)
+    # Load config
+    config = get_config(config_override)
+    databases = config['databases']
+
+    # State of each watched database, by tag (see `watch_check()`)
+    states = {}
+
+    print(' * Watching migrations (press Ctrl+C to stop)')
+
+    try:
+        iteration = 0
+        while iterations is None or iteration < iterations:
+            iteration += 1
+
+            for tag in sorted(databases):
+                # If a tag is specified, skip other tags
+                if tag_override and tag_override != tag:
+                    continue
+
+                watch_check(tag, databases[tag], states.setdefault(tag, {}),
+                            redo, retry_delay)
+
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print(' * Stopped watching')
+    finally:
+        for state in states.values():
+            if 'connection' in state:
+                state['connection'].close()
 
     return True
 
@@ -406,9 +1431,28 @@ def main():
                         help="Rollback a migration")
     parser.add_argument("-s", "--skip_missing", action='store_true',
                         help="Skip missing migration folders")
+    parser.add_argument("-p", "--profile", type=str,
+                        help="Write a Chrome trace of the run to this file and print a summary")
+    parser.add_argument("-v", "--verify", action='store_true',
+                        help="Check databases for schema drift instead of applying migrations")
+    parser.add_argument("-w", "--watch", action='store_true',
+                        help="Watch migrations folders and apply new migrations as they appear")
+    parser.add_argument("--redo", action='store_true',
+                        help="With `--watch`, redo the most recent migration when its `up.sql` changes (not supported for archives)")
+    parser.add_argument("--pack", type=str, nargs=2, metavar=('PATH', 'ARCHIVE'),
+                        help="Pack a migrations folder into an archive usable as `path`")
     args = parser.parse_args()
 
-    apply(args.config, args.tag, args.rollback, args.skip_missing)
+    if args.pack:
+        pack_migrations(*args.pack)
+        return
+
+    if args.watch:
+        watch(args.config, args.tag, args.redo)
+        return
+
+    apply(args.config, args.tag, args.rollback,
+          args.skip_missing, args.profile, args.verify)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,16 @@
 import unittest
 import psycopg2
+import psycopg2.errors
 import pymysql
 import datetime
+import tempfile
+import json
+import os
+import time
+import functools
+import hashlib
+import uuid
+import yaml
 
 from .. import schema_change
 
@@ -11,6 +20,59 @@ class Test(unittest.TestCase):
     config_path = 'src/unittest/utils/config/dbschema.yml'
     config_path_empty_db = 'src/unittest/utils/config/dbschema_empty_db.yml'
 
+    def test_trace(self):
+        # Spans are not recorded unless profiling is enabled
+        with schema_change.trace('some_phase'):
+            pass
+        self.assertEqual(schema_change.stop_profiling(), [])
+
+        schema_change.start_profiling()
+        with schema_change.trace('tag', tag='some_tag'):
+            with schema_change.trace('some_phase', migration='one'):
+                pass
+        events = schema_change.stop_profiling()
+
+        self.assertEqual([event['name'] for event in events],
+                         ['some_phase', 'tag'])
+        self.assertEqual(events[0]['args'], {
+                         'tag': 'some_tag', 'migration': 'one'})
+        self.assertEqual(events[1]['args'], {'tag': 'some_tag'})
+        self.assertEqual(events[0]['ph'], 'X')
+
+    def test_traced(self):
+        schema_change.start_profiling()
+        schema_change.parse_statements('SELECT 1;', engine='mysql')
+        events = schema_change.stop_profiling()
+
+        self.assertEqual(events[0]['name'], 'parse_statements')
+
+    def test_write_trace(self):
+        schema_change.start_profiling()
+        with schema_change.trace('some_phase'):
+            pass
+        events = schema_change.stop_profiling()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'trace.json')
+            self.assertTrue(schema_change.write_trace(events, path))
+
+            with open(path) as f:
+                self.assertEqual(json.load(f)['traceEvents'], events)
+
+    def test_get_profile_summary(self):
+        events = [
+            {'name': 'a', 'dur': 1000},
+            {'name': 'b', 'dur': 5000},
+            {'name': 'a', 'dur': 3000},
+        ]
+        summary = schema_change.get_profile_summary(events)
+
+        self.assertEqual(summary[0], {'name': 'b', 'count': 1,
+                                      'total': 5, 'max': 5})
+        self.assertEqual(summary[1], {'name': 'a', 'count': 2,
+                                      'total': 4, 'max': 3})
+        self.assertTrue(schema_change.print_profile_summary(events))
+
     def test_get_config(self):
         config = schema_change.get_config(self.config_path)
 
@@ -45,6 +107,97 @@ class Test(unittest.TestCase):
         self.assertTrue(
             'src/unittest/utils/migrations/mysql/three/up.sql' in migration_files)
 
+    def test_is_archive(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            archive = os.path.join(tmp, 'migrations.zip')
+            schema_change.pack_migrations(
+                'src/unittest/utils/migrations/mysql', archive)
+
+            self.assertTrue(schema_change.is_archive(archive))
+            self.assertTrue(schema_change.is_archive(archive + '/'))
+            self.assertFalse(schema_change.is_archive(
+                'src/unittest/utils/migrations/mysql/'))
+
+            # A folder named `*.zip` is not an archive
+            folder = os.path.join(tmp, 'folder.zip')
+            os.mkdir(folder)
+            self.assertFalse(schema_change.is_archive(folder + '/'))
+            self.assertTrue(schema_change.check_exists(folder + '/', 'dir'))
+
+            schema_change.close_archive(archive)
+
+    def test_split_archive_path(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            archive = os.path.join(tmp, 'migrations.zip')
+            schema_change.pack_migrations(
+                'src/unittest/utils/migrations/mysql', archive)
+
+            self.assertEqual(schema_change.split_archive_path(archive + '/one/up.sql'),
+                             (archive, 'one/up.sql'))
+            self.assertIsNone(schema_change.split_archive_path(
+                os.path.join(tmp, 'folder.zip/one/up.sql')))
+            self.assertIsNone(schema_change.split_archive_path(
+                'src/unittest/utils/migrations/mysql/one/up.sql'))
+            self.assertIsNone(schema_change.split_archive_path(
+                'src/unittest/utils/migrations/mysql/non_existent/up.sql'))
+
+            schema_change.close_archive(archive)
+
+            # Archives are not detected by their extension
+            archive = os.path.join(tmp, 'db1.pack')
+            schema_change.pack_migrations(
+                'src/unittest/utils/migrations/mysql', archive)
+
+            self.assertEqual(schema_change.split_archive_path(archive + '/one/down.sql'),
+                             (archive, 'one/down.sql'))
+            self.assertTrue(schema_change.check_exists(
+                archive + '/one/down.sql'))
+            self.assertEqual(schema_change.get_migration_source(archive + '/one/down.sql').strip(),
+                             'DROP TABLE one;')
+
+            schema_change.close_archive(archive)
+
+    def test_get_archive(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # Test exception for a file that is not an archive
+            path = os.path.join(tmp, 'migrations.zip')
+            with open(path, 'w') as f:
+                f.write('not an archive')
+
+            self.assertRaises(RuntimeError, schema_change.get_archive, path)
+            self.assertRaises(RuntimeError, schema_change.check_exists,
+                              path + '/', 'dir')
+
+    def test_pack_migrations(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            archive = os.path.join(tmp, 'migrations.zip')
+
+            self.assertTrue(schema_change.pack_migrations(
+                'src/unittest/utils/migrations/mysql', archive))
+
+            # Archive can be used as a migrations path
+            self.assertTrue(schema_change.check_exists(archive + '/', 'dir'))
+            self.assertTrue(schema_change.check_exists(
+                archive + '/one/down.sql'))
+            self.assertRaises(RuntimeError, schema_change.check_exists,
+                              archive + '/two/down.sql')
+
+            migration_files = schema_change.get_migrations_files(
+                archive + '/')
+            self.assertEqual(migration_files, [archive + '/one/up.sql',
+                                               archive + '/three/up.sql',
+                                               archive + '/two/up.sql'])
+            self.assertEqual(schema_change.get_migration_name(
+                migration_files[0]), 'one')
+            self.assertEqual(schema_change.get_migration_source(archive + '/one/down.sql').strip(),
+                             'DROP TABLE one;')
+
+            self.assertTrue(schema_change.close_archive(archive))
+
+        # Check exception for non existent archive
+        self.assertRaises(RuntimeError, schema_change.check_exists,
+                          'src/unittest/utils/non_existent.zip/', 'dir')
+
     def test_add_slash(self):
         self.assertEqual(schema_change.add_slash('some/path')[-1], '/')
         self.assertEqual(schema_change.add_slash('some/path/')[-1], '/')
@@ -235,6 +388,100 @@ $$;"""
         self.assertTrue(schema_change.run_migration(
             connection, 'SELECT 1', engine='postgresql'))
 
+    def test_run_migration_2(self):
+        """ Test statements cancelled by the watchdog """
+
+        config = schema_change.get_config(self.config_path)
+
+        for tag, sleep in [('tag_postgresql', 'SELECT pg_sleep(5)'), ('tag_mysql', 'SELECT SLEEP(5)')]:
+            database = config['databases'][tag]
+            connect = functools.partial(
+                schema_change.get_connection, database['engine'], database['host'], database['user'], database['port'], database['password'], database['db'], schema_change.get_ssl(database))
+            connection = connect()
+
+            # Within budget
+            self.assertTrue(schema_change.run_migration(
+                connection, 'SELECT 1', database['engine'], {'statement_timeout': 5}, connect))
+
+            # Statement budget exceeded
+            self.assertRaises(RuntimeError, schema_change.run_migration,
+                              connection, sleep, database['engine'], {'statement_timeout': 0.5}, connect)
+
+            # Migration budget exceeded
+            self.assertRaises(RuntimeError, schema_change.run_migration,
+                              connection, 'SELECT 1; ' + sleep, database['engine'], {'migration_timeout': 0.5}, connect)
+
+            # Migration budget spent before the statement starts
+            self.assertRaises(RuntimeError, schema_change.run_migration,
+                              connection, 'SELECT 1', database['engine'], {'migration_timeout': 0.000001}, connect)
+
+            # Connection is usable after the rollback
+            self.assertTrue(schema_change.run_migration(
+                connection, 'SELECT 1', database['engine']))
+
+    def test_get_partitions(self):
+        self.assertEqual(schema_change.get_partitions('SELECT 1;'), 1)
+        self.assertEqual(schema_change.get_partitions(
+            '-- dbschema: partitions=8\nSELECT 1;'), 8)
+        self.assertEqual(schema_change.get_partitions(
+            '-- dbschema: partitions=0\nSELECT 1;'), 1)
+        self.assertEqual(schema_change.get_partitions(
+            '-- dbschema: partitions=1000\nSELECT 1;'), schema_change.max_partitions)
+
+    def test_split_statements(self):
+        self.assertEqual(schema_change.split_statements([1, 2, 3, 4, 5], 2),
+                         [[1, 2, 3], [4, 5]])
+        self.assertEqual(schema_change.split_statements([1, 2], 4),
+                         [[1], [2]])
+        self.assertEqual(schema_change.split_statements([], 4), [])
+
+    def get_partition_rows(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM partition_rows")
+            count = cursor.fetchone()[0]
+            connection.commit()
+
+        return count
+
+    def test_run_partitioned_migration(self):
+        config = schema_change.get_config(self.config_path)
+        database = config['databases']['tag_postgresql']
+        connect = schema_change.get_connect(database)
+
+        connection = connect()
+        schema_change.run_migration(connection, """
+            DROP TABLE IF EXISTS partition_rows;
+            CREATE TABLE partition_rows (id int);
+        """, 'postgresql')
+
+        queries = """
+        -- dbschema: partitions=3
+        INSERT INTO partition_rows (id) VALUES (1);
+        INSERT INTO partition_rows (id) VALUES (2);
+        INSERT INTO partition_rows (id) VALUES (3);
+        INSERT INTO partition_rows (id) VALUES (4);
+        INSERT INTO partition_rows (id) VALUES (5);
+        """
+
+        # Test exception for a failed partition, all partitions rolled back
+        self.assertRaises(RuntimeError, schema_change.run_partitioned_migration,
+                          queries + "INSERT INTO non_existent (id) VALUES (6);", 'postgresql', 3, connect)
+        self.assertEqual(self.get_partition_rows(connection), 0)
+
+        # Session set up on each partition connection
+        self.assertTrue(schema_change.run_partitioned_migration(
+            queries, 'postgresql', 3, connect, None, 'SET search_path TO public;'))
+        self.assertEqual(self.get_partition_rows(connection), 5)
+
+        # Test exception for statements other than INSERT or COPY
+        self.assertRaises(RuntimeError, schema_change.run_partitioned_migration,
+                          queries + "DELETE FROM partition_rows;", 'postgresql', 3, connect)
+        self.assertEqual(self.get_partition_rows(connection), 5)
+
+        schema_change.run_migration(
+            connection, "DROP TABLE partition_rows;", 'postgresql')
+        connection.close()
+
     def test_save_migration(self):
         config = schema_change.get_config(self.config_path)
         database = config['databases']['tag_postgresql']
@@ -246,6 +493,21 @@ $$;"""
         self.assertTrue(schema_change.save_migration(
             connection, 'some_migration'))
 
+    def test_save_migration_2(self):
+        """ Test saving a migration with a schema hash """
+
+        config = schema_change.get_config(self.config_path)
+        database = config['databases']['tag_postgresql']
+
+        # Get database connection
+        connection = schema_change.get_pg_connection(
+            database['host'], database['user'], database['port'], database['password'], database['db'], schema_change.get_ssl(database))
+
+        self.assertTrue(schema_change.save_migration(
+            connection, 'some_migration', 'd41d8cd98f00b204e9800998ecf8427e', '{}'))
+        self.assertTrue(schema_change.delete_migration(
+            connection, 'some_migration'))
+
     def test_delete_migration(self):
         config = schema_change.get_config(self.config_path)
         database = config['databases']['tag_postgresql']
@@ -312,6 +574,316 @@ $$;"""
             self.assertRaises(RuntimeError, schema_change.get_migrations_applied,
                               database['engine'], connection)
 
+    def test_get_migrations_pending(self):
+        config = schema_change.get_config(self.config_path)
+        database = config['databases']['tag_postgresql']
+
+        # Get database connection
+        connection = schema_change.get_pg_connection(
+            database['host'], database['user'], database['port'], database['password'], database['db'], schema_change.get_ssl(database))
+
+        schema_change.apply_migrations(
+            database['engine'], connection, database['path'])
+
+        self.assertEqual(schema_change.get_migrations_pending(
+            database['engine'], connection, database['path']), [])
+
+    def test_get_hook_key(self):
+        server = ('postgresql', 'localhost', 5432, 'my_db')
+
+        self.assertEqual(schema_change.get_hook_key(server, 'SELECT 1;'),
+                         schema_change.get_hook_key(server, ' SELECT 1;\n'))
+        self.assertNotEqual(schema_change.get_hook_key(server, 'SELECT 1;'),
+                            schema_change.get_hook_key(server, 'SELECT 2;'))
+
+    def test_run_hook(self):
+        config = schema_change.get_config(self.config_path)
+        database = config['databases']['tag_postgresql']
+        server = ('postgresql', 'localhost', 5432, 'my_db')
+
+        # Get database connection
+        connection = schema_change.get_pg_connection(
+            database['host'], database['user'], database['port'], database['password'], database['db'], schema_change.get_ssl(database))
+
+        self.assertFalse(schema_change.run_hook(
+            connection, '', 'postgresql'))
+        self.assertTrue(schema_change.run_hook(
+            connection, 'SELECT 1', 'postgresql', 'always', False))
+        self.assertFalse(schema_change.run_hook(
+            connection, 'SELECT 1', 'postgresql', 'on_change', False))
+        self.assertTrue(schema_change.run_hook(
+            connection, 'SELECT 1', 'postgresql', 'on_change', True))
+
+        # Deduplicated within a run
+        hooks_ran = set()
+        self.assertTrue(schema_change.run_hook(
+            connection, 'SELECT 1', 'postgresql', 'once_per_server', True, server, hooks_ran))
+        self.assertFalse(schema_change.run_hook(
+            connection, 'SELECT 1', 'postgresql', 'once_per_server', True, server, hooks_ran))
+
+        # Test exception for invalid hooks mode
+        self.assertRaises(RuntimeError, schema_change.run_hook,
+                          connection, 'SELECT 1', 'postgresql', 'never')
+
+    def test_get_schema_tables(self):
+        config = schema_change.get_config(self.config_path)
+
+        for tag in ['tag_postgresql', 'tag_mysql']:
+            database = config['databases'][tag]
+            connection = schema_change.get_connect(database)()
+
+            tables = schema_change.get_schema_tables(
+                database['engine'], connection)
+
+            self.assertIsInstance(tables, dict)
+            for name in tables:
+                self.assertFalse(name.endswith('migrations_applied'))
+                self.assertEqual(len(tables[name]), 32)
+
+    def test_get_schema_hash(self):
+        config = schema_change.get_config(self.config_path)
+
+        for tag in ['tag_postgresql', 'tag_mysql']:
+            database = config['databases'][tag]
+            connection = schema_change.get_connect(database)()
+
+            row = schema_change.get_schema_hash(database['engine'], connection)
+
+            self.assertEqual(len(row['schema_hash']), 32)
+            self.assertIn('expected_hash', row)
+
+    def test_hash_schema_tables(self):
+        self.assertEqual(schema_change.hash_schema_tables({}),
+                         'd41d8cd98f00b204e9800998ecf8427e')
+        self.assertEqual(schema_change.hash_schema_tables({'b': '2', 'a': '1'}),
+                         hashlib.md5(b'a:1,b:2').hexdigest())
+
+        # Same hash as computed server side
+        config = schema_change.get_config(self.config_path)
+
+        for tag in ['tag_postgresql', 'tag_mysql']:
+            database = config['databases'][tag]
+            connection = schema_change.get_connect(database)()
+
+            self.assertEqual(schema_change.hash_schema_tables(schema_change.get_schema_tables(database['engine'], connection)),
+                             schema_change.get_schema_hash(database['engine'], connection)['schema_hash'])
+
+    def test_verify_database(self):
+        # Skipped without `schema_hash`
+        self.assertTrue(schema_change.verify_database(
+            'some_tag', {'engine': 'mysql', 'db': 'my_db', 'user': 'root'}))
+
+    def test_verify_schema(self):
+        config = schema_change.get_config(self.config_path)
+        database = config['databases']['tag_postgresql']
+        connection = schema_change.get_connect(database)()
+
+        # Save the current schema as expected
+        schema_change.save_migration(connection, 'some_migration',
+                                     schema_change.get_schema_hash(
+                                         'postgresql', connection)['schema_hash'],
+                                     json.dumps(schema_change.get_schema_tables('postgresql', connection)))
+        self.assertTrue(schema_change.verify_schema('postgresql', connection))
+
+        # Drift
+        schema_change.run_migration(
+            connection, 'CREATE TABLE drift (id int);', 'postgresql')
+        self.assertFalse(schema_change.verify_schema(
+            'postgresql', connection))
+        self.assertEqual(schema_change.get_expected_schema_tables(
+            'postgresql', connection).get('public.drift'), None)
+
+        schema_change.run_migration(
+            connection, 'DROP TABLE drift;', 'postgresql')
+        schema_change.delete_migration(connection, 'some_migration')
+
+    def test_verify_schema_2(self):
+        config = schema_change.get_config(self.config_path)
+        database = config['databases']['tag_postgresql']
+        connection = schema_change.get_connect(database)()
+
+        schema_change.run_migration(
+            connection, 'CREATE TABLE drift (name varchar(10));', 'postgresql')
+
+        # Save the current schema as expected
+        schema_change.save_migration(connection, 'some_migration',
+                                     schema_change.get_schema_hash(
+                                         'postgresql', connection)['schema_hash'],
+                                     json.dumps(schema_change.get_schema_tables('postgresql', connection)))
+        self.assertTrue(schema_change.verify_schema('postgresql', connection))
+
+        # Drift of a column length
+        schema_change.run_migration(
+            connection, 'ALTER TABLE drift ALTER COLUMN name TYPE varchar(20);', 'postgresql')
+        self.assertFalse(schema_change.verify_schema(
+            'postgresql', connection))
+
+        schema_change.run_migration(
+            connection, 'DROP TABLE drift;', 'postgresql')
+        schema_change.delete_migration(connection, 'some_migration')
+
+    def test_check_schema_hash_columns(self):
+        config = schema_change.get_config(self.config_path)
+        database = config['databases']['tag_postgresql']
+        connection = schema_change.get_connect(database)()
+
+        self.assertTrue(schema_change.check_schema_hash_columns(
+            'postgresql', connection))
+
+        # Test exception for a `migrations_applied` table without the columns
+        schema_change.run_migration(connection, """
+            DROP SCHEMA IF EXISTS no_hash CASCADE;
+            CREATE SCHEMA no_hash;
+            CREATE TABLE no_hash.migrations_applied (id serial, name text, date timestamp);
+            SET search_path TO no_hash;
+        """, 'postgresql')
+        self.assertRaises(RuntimeError, schema_change.check_schema_hash_columns,
+                          'postgresql', connection)
+
+        connection.rollback()
+        schema_change.run_migration(connection, """
+            SET search_path TO public;
+            DROP SCHEMA no_hash CASCADE;
+        """, 'postgresql')
+        connection.close()
+
+    def test_run_deferred_hooks(self):
+        config = schema_change.get_config(self.config_path)
+        database = config['databases']['tag_postgresql']
+        server = ('postgresql', 'localhost', 5432, 'my_db')
+
+        # Get database connection
+        connection = schema_change.get_pg_connection(
+            database['host'], database['user'], database['port'], database['password'], database['db'], schema_change.get_ssl(database))
+
+        schema_change.run_migration(connection, """
+            DROP TABLE IF EXISTS hook_runs;
+            CREATE TABLE hook_runs (hook text);
+        """, 'postgresql')
+
+        hook = "INSERT INTO hook_runs (hook) VALUES ('post');"
+        self.assertTrue(schema_change.run_deferred_hooks([
+            (connection, hook, 'postgresql', server),
+            (connection, hook, 'postgresql', server),
+        ]))
+
+        # Duplicate ran once
+        self.assertEqual(self.get_hook_runs(connection, 'post'), 1)
+
+    def get_hook_runs(self, connection, hook):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT COUNT(*) FROM hook_runs WHERE hook = %s", (hook,))
+            count = cursor.fetchone()[0]
+            connection.commit()
+
+        return count
+
+    def write_hooks_config(self, tmp, tags):
+        """ Write a config with one new migration per tag, each in its own folder """
+
+        database = schema_change.get_config(
+            self.config_path)['databases']['tag_postgresql']
+
+        databases = {}
+        for tag, options in tags.items():
+            path = os.path.join(tmp, tag)
+            migration = os.path.join(path, 'hooks_%s_%s' % (tag, uuid.uuid4().hex))
+            os.makedirs(migration)
+            with open(os.path.join(migration, 'up.sql'), 'w') as f:
+                f.write(options.pop('up', "INSERT INTO hook_runs (hook) VALUES ('migration');"))
+
+            databases[tag] = dict(database, path=path + '/', **options)
+
+        config_path = os.path.join(tmp, 'dbschema.yml')
+        with open(config_path, 'w') as f:
+            yaml.safe_dump({'databases': databases}, f)
+
+        return config_path
+
+    def setup_hook_runs(self):
+        config = schema_change.get_config(self.config_path)
+        connection = schema_change.get_connect(
+            config['databases']['tag_postgresql'])()
+
+        schema_change.run_migration(connection, """
+            DROP TABLE IF EXISTS hook_runs;
+            CREATE TABLE hook_runs (hook text);
+        """, 'postgresql')
+
+        return connection
+
+    def test_apply_hooks_once_per_server(self):
+        connection = self.setup_hook_runs()
+        hooks = {
+            'hooks_mode': 'once_per_server',
+            'pre_migration': "INSERT INTO hook_runs (hook) VALUES ('pre');",
+            'post_migration': "INSERT INTO hook_runs (hook) VALUES ('post');",
+        }
+
+        with tempfile.TemporaryDirectory() as tmp:
+            config_path = self.write_hooks_config(
+                tmp, {'a': dict(hooks), 'b': dict(hooks)})
+
+            self.assertTrue(schema_change.apply(config_override=config_path))
+
+        # Pre hooks run on each tag connection, identical post hooks once
+        self.assertEqual(self.get_hook_runs(connection, 'migration'), 2)
+        self.assertEqual(self.get_hook_runs(connection, 'pre'), 2)
+        self.assertEqual(self.get_hook_runs(connection, 'post'), 1)
+
+    def test_apply_hooks_once_per_server_2(self):
+        """ Test deferred post hooks when a later tag fails """
+
+        connection = self.setup_hook_runs()
+        hooks = {
+            'hooks_mode': 'once_per_server',
+            'post_migration': "INSERT INTO hook_runs (hook) VALUES ('post');",
+        }
+
+        with tempfile.TemporaryDirectory() as tmp:
+            config_path = self.write_hooks_config(tmp, {
+                'a': dict(hooks),
+                'b': dict(hooks, up='SELECT * FROM non_existent;'),
+            })
+
+            self.assertRaises(psycopg2.Error, schema_change.apply,
+                              config_override=config_path)
+
+        # Tag `a` migrated, its post hook still ran
+        self.assertEqual(self.get_hook_runs(connection, 'migration'), 1)
+        self.assertEqual(self.get_hook_runs(connection, 'post'), 1)
+
+    def test_apply_hooks_always(self):
+        """ Test that the pre hook runs before listing migrations """
+
+        connection = self.setup_hook_runs()
+        schema_change.run_migration(connection, """
+            CREATE SCHEMA IF NOT EXISTS hooks_test;
+            DROP TABLE IF EXISTS hooks_test.migrations_applied;
+            CREATE TABLE hooks_test.migrations_applied (LIKE public.migrations_applied INCLUDING ALL);
+        """, 'postgresql')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            config_path = self.write_hooks_config(tmp, {'a': {
+                'hooks_mode': 'always',
+                'pre_migration': 'SET search_path TO hooks_test, public;',
+            }})
+            migration = os.listdir(os.path.join(tmp, 'a'))[0]
+
+            # Only applied according to the table in `hooks_test`
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO hooks_test.migrations_applied (name, date) VALUES (%s, NOW())", (migration,))
+                connection.commit()
+
+            self.assertTrue(schema_change.apply(config_override=config_path))
+
+        self.assertEqual(self.get_hook_runs(connection, 'migration'), 0)
+
+        schema_change.run_migration(
+            connection, 'DROP SCHEMA hooks_test CASCADE;', 'postgresql')
+
     def test_apply_migrations(self):
         config = schema_change.get_config(self.config_path)
         database = config['databases']['tag_postgresql']
@@ -346,6 +918,131 @@ $$;"""
 
             self.assertIsInstance(schema_change.get_ssl(database), dict)
 
+    def test_get_time_budget(self):
+        self.assertEqual(schema_change.get_time_budget({'engine': 'mysql'}), {})
+        self.assertEqual(schema_change.get_time_budget({'engine': 'mysql', 'statement_timeout': 10}),
+                         {'statement_timeout': 10})
+
+    def test_get_statement_budget(self):
+        started = time.monotonic()
+
+        self.assertIsNone(schema_change.get_statement_budget({}, started))
+        self.assertEqual(schema_change.get_statement_budget(
+            {'statement_timeout': 10}, started), 10)
+        self.assertLessEqual(schema_change.get_statement_budget(
+            {'statement_timeout': 10, 'migration_timeout': 5}, started), 5)
+        self.assertLessEqual(schema_change.get_statement_budget(
+            {'migration_timeout': 5}, started - 10), 0)
+
+    def test_get_migrations_snapshot(self):
+        snapshot = schema_change.get_migrations_snapshot(
+            'src/unittest/utils/migrations/mysql/')
+
+        self.assertEqual(sorted(snapshot), ['src/unittest/utils/migrations/mysql/one/down.sql',
+                                            'src/unittest/utils/migrations/mysql/one/up.sql',
+                                            'src/unittest/utils/migrations/mysql/three/up.sql',
+                                            'src/unittest/utils/migrations/mysql/two/up.sql'])
+        self.assertEqual(schema_change.get_migrations_snapshot(
+            'src/unittest/utils/non_existent/'), {})
+
+        with tempfile.TemporaryDirectory() as tmp:
+            archive = os.path.join(tmp, 'migrations.zip')
+            schema_change.pack_migrations(
+                'src/unittest/utils/migrations/mysql', archive)
+
+            self.assertEqual(list(schema_change.get_migrations_snapshot(
+                archive + '/')), [archive])
+            schema_change.close_archive(archive)
+
+    def test_get_latest_migration(self):
+        config = schema_change.get_config(self.config_path)
+        database = config['databases']['tag_postgresql']
+
+        # Get database connection
+        connection = schema_change.get_pg_connection(
+            database['host'], database['user'], database['port'], database['password'], database['db'], schema_change.get_ssl(database))
+
+        schema_change.apply_migrations(
+            database['engine'], connection, database['path'])
+
+        self.assertEqual(schema_change.get_latest_migration(database['engine'], connection, database['path']),
+                         database['path'] + 'two/up.sql')
+
+    def test_watch_check(self):
+        connection = self.setup_hook_runs()
+        database = schema_change.get_config(
+            self.config_path)['databases']['tag_postgresql']
+        prefix = 'watch_%s_' % uuid.uuid4().hex
+
+        def write(name, file, source):
+            os.makedirs(os.path.join(tmp, prefix + name), exist_ok=True)
+            with open(os.path.join(tmp, prefix + name, file), 'w') as f:
+                f.write(source)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            database = dict(database, path=tmp + '/')
+            state = {}
+
+            # Files are applied once unchanged between two checks
+            self.assertFalse(schema_change.watch_check(
+                'tag', database, state, redo=True))
+            self.assertTrue(schema_change.watch_check(
+                'tag', database, state, redo=True))
+
+            write('1', 'up.sql', "INSERT INTO hook_runs (hook) VALUES ('1');")
+            self.assertFalse(schema_change.watch_check(
+                'tag', database, state, redo=True))
+            self.assertEqual(self.get_hook_runs(connection, '1'), 0)
+            self.assertTrue(schema_change.watch_check(
+                'tag', database, state, redo=True))
+            self.assertEqual(self.get_hook_runs(connection, '1'), 1)
+
+            # A broken migration is not retried until modified
+            write('2', 'up.sql', 'SELECT * FROM non_existent;')
+            schema_change.watch_check('tag', database, state, redo=True)
+            self.assertFalse(schema_change.watch_check(
+                'tag', database, state, redo=True))
+            self.assertFalse(schema_change.watch_check(
+                'tag', database, state, redo=True))
+
+            write('2', 'up.sql', "INSERT INTO hook_runs (hook) VALUES ('2');")
+            write('2', 'down.sql',
+                  "INSERT INTO hook_runs (hook) VALUES ('2_down');")
+            schema_change.watch_check('tag', database, state, redo=True)
+            self.assertTrue(schema_change.watch_check(
+                'tag', database, state, redo=True))
+            self.assertEqual(self.get_hook_runs(connection, '2'), 1)
+
+            # The most recent migration is redone when its `up.sql` changes
+            write('2', 'up.sql',
+                  "-- Changed\nINSERT INTO hook_runs (hook) VALUES ('2');")
+            schema_change.watch_check('tag', database, state, redo=True)
+            self.assertTrue(schema_change.watch_check(
+                'tag', database, state, redo=True))
+            self.assertEqual(self.get_hook_runs(connection, '2_down'), 1)
+            self.assertEqual(self.get_hook_runs(connection, '2'), 2)
+
+            state['connection'].close()
+
+        schema_change.delete_migration(connection, prefix + '1')
+        schema_change.delete_migration(connection, prefix + '2')
+
+    def test_is_connection_error(self):
+        self.assertTrue(schema_change.is_connection_error(
+            pymysql.err.OperationalError(2006, 'MySQL server has gone away')))
+        self.assertFalse(schema_change.is_connection_error(
+            pymysql.err.OperationalError(1054, 'Unknown column')))
+        self.assertTrue(schema_change.is_connection_error(
+            psycopg2.OperationalError('server closed the connection unexpectedly')))
+        self.assertFalse(schema_change.is_connection_error(
+            psycopg2.errors.UndefinedTable('relation does not exist')))
+        self.assertFalse(schema_change.is_connection_error(
+            RuntimeError('some error')))
+
+    def test_watch(self):
+        self.assertTrue(schema_change.watch(config_override=self.config_path,
+                                            redo=True, interval=0, iterations=2))
+
     def test_apply(self):
         self.assertTrue(schema_change.apply(config_override=self.config_path,
                                             skip_missing=True))
@@ -357,6 +1054,17 @@ $$;"""
         self.assertTrue(schema_change.apply(config_override=self.config_path,
                                             skip_missing=True))
 
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'trace.json')
+            self.assertTrue(schema_change.apply(config_override=self.config_path,
+                                                tag_override='tag_postgresql',
+                                                profile=path))
+            self.assertTrue(os.path.isfile(path))
+
+        self.assertTrue(schema_change.apply(config_override=self.config_path,
+                                            tag_override='tag_postgresql',
+                                            verify=True))
+
         # Test exception for rollback without a tag
         self.assertRaises(RuntimeError, schema_change.apply,
                           self.config_path, None, 'one')